@@ -1,116 +1,389 @@
 import os
 import sys
+import gc
 import json
+import logging
 import traceback
 import time
+import threading
+from collections import deque
 from datetime import datetime
 from PIL import Image
-from transformers import AutoProcessor, Qwen2_5_VLForConditionalGeneration
-from qwen_vl_utils import process_vision_info
-import torch
+# torch, transformers и qwen_vl_utils импортируются лениво (при загрузке модели и в рабочем потоке),
+# чтобы окно появлялось сразу, без ожидания загрузки тяжелых библиотек
 from PySide6.QtWidgets import (
     QApplication, QWidget, QLabel, QPushButton,
     QPlainTextEdit, QVBoxLayout, QHBoxLayout, QGridLayout,
-    QFileDialog, QMessageBox, QComboBox, QFrame
+    QFileDialog, QMessageBox, QComboBox, QFrame, QSpinBox
 )
-from PySide6.QtGui import QFont
-from PySide6.QtCore import Qt, QObject, Signal, Slot, QThread
+from PySide6.QtGui import QFont, QTextCursor
+from PySide6.QtCore import Qt, QObject, Signal, Slot, QThread, QTimer
 
 # Путь к директории с моделями
 BASE_MODEL_DIR = os.path.join(os.path.dirname(__file__), "model_bnb4")
 # Путь к файлу с шаблонами промтов
 PROMPTS_FILE = os.path.join(os.path.dirname(__file__), "prompts.json")
+# Папка для кэша скомпилированных ядер torch.compile (переиспользуется между запусками)
+TORCH_COMPILE_CACHE_DIR = os.path.join(os.path.dirname(__file__), "torch_compile_cache")
+
+# Максимальный размер стороны изображения после ресайза
+MAX_IMAGE_SIZE = 1536
+# Количество генерируемых токенов по умолчанию (типичная страница OCR - меньше 1000 токенов)
+DEFAULT_MAX_NEW_TOKENS = 1024
+# Верхняя граница количества генерируемых токенов, доступная в интерфейсе для длинных страниц
+MAX_NEW_TOKENS_LIMIT = 8192
+# Запас под токены промта: изображение до MAX_IMAGE_SIZE дает до (MAX_IMAGE_SIZE // 28)² визуальных токенов
+MAX_PROMPT_TOKENS = (MAX_IMAGE_SIZE // 28) ** 2 + 256
+# Количество изображений, обрабатываемых одним вызовом generate в пакетном режиме (по умолчанию и максимум).
+# Каждое изображение добавляет до (MAX_IMAGE_SIZE // 28)² токенов в префилл, поэтому по умолчанию пакет небольшой
+DEFAULT_BATCH_SIZE = 2
+MAX_BATCH_SIZE = 8
+# Расширения файлов, которые считаются изображениями при выборе папки
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tiff")
+# Стороны уменьшенного изображения кратны сетке патчей Qwen2.5-VL (патч 14 px, слияние 2x2),
+# чтобы процессор не делал второй ресайз
+IMAGE_SIZE_MULTIPLE = 28
+
+def scaled_size(width, height):
+    """Возвращает размер для ресайза или исходный размер, если изображение не больше MAX_IMAGE_SIZE.
+
+    Большие изображения масштабируются один раз с сохранением пропорций: большая сторона становится
+    наибольшим кратным IMAGE_SIZE_MULTIPLE в пределах MAX_IMAGE_SIZE, меньшая округляется до ближайшего кратного.
+    """
+    if max(width, height) <= MAX_IMAGE_SIZE:
+        return width, height
+    limit = (MAX_IMAGE_SIZE // IMAGE_SIZE_MULTIPLE) * IMAGE_SIZE_MULTIPLE
+    ratio = limit / max(width, height)
+    return tuple(
+        max(IMAGE_SIZE_MULTIPLE, round(dim * ratio / IMAGE_SIZE_MULTIPLE) * IMAGE_SIZE_MULTIPLE)
+        for dim in (width, height)
+    )
+
+def build_kv_cache(model, max_new_tokens):
+    """Создает StaticCache на промт до MAX_PROMPT_TOKENS токенов и ответ до max_new_tokens токенов."""
+    from transformers import StaticCache
+
+    return StaticCache(
+        config=model.config,
+        max_batch_size=1,
+        max_cache_len=MAX_PROMPT_TOKENS + max_new_tokens,
+        device=model.device,
+        dtype=model.dtype,
+    )
 
 class OCRWorker(QObject):
     """Рабочий поток для выполнения OCR. Обеспечивает отзывчивость интерфейса."""
     finished = Signal(str)  # Сигнал с результатом
     log = Signal(str)       # Сигнал для записи в лог
+    partial = Signal(str)   # Сигнал с очередным фрагментом текста при потоковой генерации
+    batch_finished = Signal(str)  # Сигнал с результатами очередного пакета при обработке папки
 
-    def __init__(self, image_path, prompt_text):
+    def __init__(self, image_paths, prompt_text, kv_cache=None, max_new_tokens=DEFAULT_MAX_NEW_TOKENS,
+                 batch_size=DEFAULT_BATCH_SIZE):
         super().__init__()
-        self.image_path = image_path
+        self.image_paths = image_paths
         self.prompt_text = prompt_text
+        self.max_new_tokens = max_new_tokens
+        self.batch_size = batch_size
+        self.kv_cache = kv_cache  # Заранее выделенный StaticCache (None - динамический кэш)
         self.processor = None
         self.model = None
+        self.prompt_cache = {}  # Кэш результатов apply_chat_template: текст промта -> строка для процессора
+
+    def gpu_preprocessing(self):
+        """Возвращает True, если изображения готовятся на GPU: модель на CUDA и процессор изображений "быстрый".
+
+        Быстрый (torchvision) процессор принимает тензоры и нормализует их на том устройстве, где они лежат.
+        """
+        return self.model.device.type == "cuda" and type(self.processor.image_processor).__name__.endswith("Fast")
+
+    def load_image(self, image_path):
+        """Открывает изображение и уменьшает его до размера из scaled_size."""
+        if self.gpu_preprocessing():
+            return self._load_image_gpu(image_path)
+        return self._load_image_cpu(image_path)
+
+    def _load_image_gpu(self, image_path):
+        """Загружает изображение в uint8-тензор на GPU и выполняет ресайз там же.
+
+        Тензор передается процессору напрямую: нормализация тоже идет на GPU, а по шине
+        копируются только сжатые байты JPEG (или uint8-пиксели для остальных форматов).
+        """
+        from torchvision.io import ImageReadMode, decode_jpeg, read_file
+        from torchvision.transforms.v2 import InterpolationMode
+        from torchvision.transforms.v2 import functional as F
+
+        device = self.model.device
+        img = None
+        if image_path.lower().endswith((".jpg", ".jpeg")):
+            try:
+                img = decode_jpeg(read_file(image_path), mode=ImageReadMode.RGB, device=device)
+            except Exception as e:
+                self.log.emit(f"⚠️ Не удалось декодировать JPEG на GPU, используется Pillow: {e}")
+        if img is None:
+            img = F.pil_to_tensor(Image.open(image_path).convert("RGB")).to(device)
+
+        # Все изображения в этом режиме уменьшаются одним и тем же фильтром (бикубический с антиалиасингом)
+        height, width = img.shape[-2:]
+        new_size = scaled_size(width, height)
+        if new_size != (width, height):
+            img = F.resize(img, [new_size[1], new_size[0]], interpolation=InterpolationMode.BICUBIC, antialias=True)
+            self.log.emit(f"Изображение уменьшено до {new_size} (GPU)")
+        return img
+
+    def _load_image_cpu(self, image_path):
+        """Открывает изображение через Pillow и выполняет ресайз на CPU."""
+        img = Image.open(image_path).convert("RGB")
+
+        # Ресайз изображения для оптимизации скорости и потребления памяти
+        max_size = MAX_IMAGE_SIZE
+        new_size = scaled_size(*img.size)
+        if new_size == img.size:
+            return img
+
+        # Огромные фото сначала быстро ужимаются box-фильтром (reduce) не меньше чем до 2x от цели,
+        # чтобы дорогой LANCZOS работал с небольшим изображением. reduce(1) - лишь копия, он пропускается
+        factor = max(img.size) // (2 * max_size)
+        if factor >= 2:
+            img = img.reduce(factor)
+
+        img = img.resize(new_size, Image.Resampling.LANCZOS)
+        self.log.emit(f"Изображение уменьшено до {new_size}")
+        return img
 
     @Slot()
     def run(self):
-        """Основной метод рабочего потока. Выполняет распознавание текста на изображении."""
+        """Основной метод рабочего потока. Выполняет распознавание текста на изображениях."""
         try:
             if self.processor is None or self.model is None:
                 self.log.emit("ОШИБКА: Модель не передана в рабочий поток!")
                 self.finished.emit("Ошибка: внутренняя ошибка приложения.")
                 return
 
-            self.log.emit("Открытие изображения...")
-            img = Image.open(self.image_path).convert("RGB")
+            # Изображения обрабатываются пачками: один вызов generate на batch_size изображений.
+            # Результат каждого пакета сразу отправляется в интерфейс, ошибка пакета не прерывает обработку папки
+            results = {}
+            total = len(self.image_paths)
+            pending = deque(
+                self.image_paths[batch_start:batch_start + self.batch_size]
+                for batch_start in range(0, total, self.batch_size)
+            )
+            while pending:
+                batch_paths = pending.popleft()
+                if total > 1:
+                    self.log.emit(f"Пакет из {len(batch_paths)} изображений, готово {len(results)} из {total}")
+                try:
+                    # Потоковый вывод в интерфейс возможен только для одного изображения
+                    texts = self.process_batch(batch_paths, stream=(total == 1))
+                except Exception as e:
+                    if total == 1:
+                        raise
+                    texts = self.handle_batch_error(e, batch_paths, pending)
+                if texts is None:
+                    continue
+
+                results.update(zip(batch_paths, texts))
+                if total > 1:
+                    self.batch_finished.emit(self.format_results(batch_paths, texts))
+
+            if total == 1:
+                result = results[self.image_paths[0]]
+            else:
+                result = self.format_results(self.image_paths, [results[path] for path in self.image_paths])
 
-            # Ресайз изображения для оптимизации скорости и потребления памяти
-            max_size = 1536
-            if max(img.size) > max_size:
-                ratio = max_size / max(img.size)
-                new_size = tuple(int(dim * ratio) for dim in img.size)
-                img = img.resize(new_size, Image.Resampling.LANCZOS)
-                self.log.emit(f"Изображение уменьшено до {new_size}")
+            self.finished.emit(result)
+            self.log.emit("Готово!")
 
-            self.log.emit("Подготовка входных данных...")
-            messages = [
+        except Exception as e:
+            import torch
+            if isinstance(e, torch.cuda.OutOfMemoryError):
+                # Возврат закэшированных аллокатором блоков, чтобы следующий запуск не упал сразу
+                torch.cuda.empty_cache()
+                error_msg = "ОШИБКА: Недостаточно видеопамяти!"
+                self.log.emit(error_msg)
+                self.finished.emit(error_msg)
+                return
+            error_msg = f"Ошибка: {e}\n{traceback.format_exc()}"
+            self.log.emit(error_msg)
+            self.finished.emit("")
+
+    def handle_batch_error(self, error, batch_paths, pending):
+        """Обрабатывает ошибку пакета при обработке папки.
+
+        При нехватке видеопамяти пакет делится пополам и возвращается в очередь (результат None).
+        Иначе возвращаются сообщения об ошибке для каждого изображения пакета.
+        """
+        import torch
+
+        if isinstance(error, torch.cuda.OutOfMemoryError):
+            # Локальные переменные упавших кадров (тензоры пакета) освобождаются до очистки кэша
+            traceback.clear_frames(error.__traceback__)
+            torch.cuda.empty_cache()
+            if len(batch_paths) > 1:
+                half = len(batch_paths) // 2
+                self.log.emit(f"⚠️ Недостаточно видеопамяти для пакета из {len(batch_paths)} изображений, пакет делится пополам.")
+                pending.appendleft(batch_paths[half:])
+                pending.appendleft(batch_paths[:half])
+                return None
+            error_msg = "ОШИБКА: Недостаточно видеопамяти!"
+        else:
+            error_msg = f"Ошибка: {error}"
+            self.log.emit(f"{error_msg}\n{traceback.format_exc()}")
+
+        names = ", ".join(os.path.basename(path) for path in batch_paths)
+        self.log.emit(f"❌ Не удалось распознать: {names}")
+        return [error_msg] * len(batch_paths)
+
+    @staticmethod
+    def format_results(image_paths, texts):
+        """Объединяет результаты нескольких изображений в один Markdown-текст с заголовками по именам файлов."""
+        return "\n\n---\n\n".join(
+            f"## {os.path.basename(path)}\n\n{text}"
+            for path, text in zip(image_paths, texts)
+        )
+
+    def process_batch(self, image_paths, stream=False):
+        """Распознает пакет изображений одним вызовом generate. Возвращает список текстов.
+
+        При stream=True сгенерированный текст по мере появления отправляется сигналом partial.
+        """
+        import torch
+        from transformers import TextIteratorStreamer
+        from qwen_vl_utils import process_vision_info
+
+        self.log.emit("Открытие изображения...")
+        images = [self.load_image(path) for path in image_paths]
+
+        self.log.emit("Подготовка входных данных...")
+        messages = [
+            [
                 {
-                    "role": "user", 
+                    "role": "user",
                     "content": [
                         {"type": "image", "image": img},
                         {"type": "text", "text": self.prompt_text}
                     ],
                 }
             ]
+            for img in images
+        ]
 
-            # Формирование промта для модели
+        # Формирование промта для модели. Плейсхолдер изображения в шаблоне не зависит
+        # от его размера, поэтому результат для одного и того же текста промта переиспользуется
+        text_prompt = self.prompt_cache.get(self.prompt_text)
+        if text_prompt is None:
             text_prompt = self.processor.apply_chat_template(
-                messages,
+                messages[0],
                 tokenize=False,
                 add_generation_prompt=True
             )
+            self.prompt_cache[self.prompt_text] = text_prompt
 
-            # Обработка изображения и подготовка тензоров
+        # Обработка изображений и подготовка тензоров (промты дополняются паддингом до общей длины).
+        # CUDA-тензоры передаются процессору напрямую: process_vision_info принимает только PIL-изображения
+        if self.gpu_preprocessing():
+            image_inputs, video_inputs = images, None
+        else:
             image_inputs, video_inputs = process_vision_info(messages)
-            inputs = self.processor(
-                text=[text_prompt],
-                images=image_inputs,
-                videos=video_inputs,
-                padding=True,
-                return_tensors="pt"
-            )
-
-            # Перемещение данных на устройство (GPU/CPU)
-            inputs = inputs.to(self.model.device)
-            self.log.emit(f"Input: {inputs['input_ids'].shape}, Pixels: {inputs['pixel_values'].shape}")
+        inputs = self.processor(
+            text=[text_prompt] * len(images),
+            images=image_inputs,
+            videos=video_inputs,
+            padding=True,
+            return_tensors="pt"
+        )
 
-            self.log.emit("Начало генерации...")
-            start_time = time.time()
+        # Перемещение данных на устройство (GPU/CPU).
+        # Из закрепленной (pinned) памяти копирование идет асинхронно и не блокирует поток
+        device = self.model.device
+        # pixel_values (самый большой тензор) приводятся к типу данных модели до копирования:
+        # по шине передается вдвое меньше байт, чем в fp32 (при подготовке на GPU копирования нет)
+        inputs["pixel_values"] = inputs["pixel_values"].to(self.model.dtype)
+        for key, value in inputs.items():
+            if torch.is_tensor(value):
+                # Тензоры, уже подготовленные на GPU, не закрепляются и не копируются повторно
+                if device.type == "cuda" and value.device.type == "cpu":
+                    value = value.pin_memory()
+                inputs[key] = value.to(device, non_blocking=True)
+        self.log.emit(f"Input: {inputs['input_ids'].shape}, Pixels: {inputs['pixel_values'].shape}")
+
+        # Статический кэш рассчитан на одно изображение и используется,
+        # только если в него помещается весь промт и ответ
+        kv_cache = self.kv_cache if len(images) == 1 else None
+        if kv_cache is not None and inputs['input_ids'].shape[1] + self.max_new_tokens > kv_cache.max_cache_len:
+            self.log.emit("⚠️ Промт не помещается в статический KV-кэш, используется динамический.")
+            kv_cache = None
+
+        self.log.emit("Начало генерации...")
+        start_time = time.time()
+
+        # Параметры генерации (исправлены для устранения предупреждений)
+        generate_kwargs = dict(
+            **inputs,
+            max_new_tokens=self.max_new_tokens,
+            min_new_tokens=10,
+            do_sample=False,
+            repetition_penalty=1.05,  # Защита от зацикливания без посимвольного n-gram-сканирования
+            length_penalty=1.0,
+            pad_token_id=self.processor.tokenizer.eos_token_id,
+            eos_token_id=self.processor.tokenizer.eos_token_id,
+            use_cache=True,
+            past_key_values=kv_cache,
+        )
 
-            # Генерация текста моделью (исправлены параметры для устранения предупреждений)
-            with torch.no_grad():
-                outputs = self.model.generate(
-                    **inputs,
-                    max_new_tokens=4096,
-                    min_new_tokens=10,
-                    do_sample=False,
-                    repetition_penalty=1.05,
-                    length_penalty=1.0,
-                    no_repeat_ngram_size=3,
-                    pad_token_id=self.processor.tokenizer.eos_token_id,
-                    eos_token_id=self.processor.tokenizer.eos_token_id,
-                    use_cache=True,
-                )
+        def generate():
+            # Кэш сбрасывается внутри inference_mode: его тензоры созданы в этом режиме.
+            # inference_mode действует только в текущем потоке, поэтому включается здесь
+            with torch.inference_mode():
+                # Очистка статического KV-кэша от предыдущего запроса
+                if kv_cache is not None:
+                    kv_cache.reset()
+                return self.model.generate(**generate_kwargs)
+
+        if stream:
+            # generate работает в отдельном потоке, а текущий поток передает фрагменты в интерфейс.
+            # Стример сам отдает только новый суффикс текста, поэтому фрагменты просто накапливаются
+            streamer = TextIteratorStreamer(
+                self.processor.tokenizer,
+                skip_prompt=True,
+                skip_special_tokens=True,
+                clean_up_tokenization_spaces=True
+            )
+            generate_kwargs["streamer"] = streamer
+            outcome = {}
+
+            def generate_in_thread():
+                try:
+                    outcome["outputs"] = generate()
+                except BaseException as e:
+                    outcome["error"] = e
+                    streamer.end()  # Иначе цикл чтения ниже никогда не завершится
+
+            generation_thread = threading.Thread(target=generate_in_thread, daemon=True)
+            generation_thread.start()
+            chunks = []
+            for new_text in streamer:
+                if new_text:
+                    chunks.append(new_text)
+                    self.partial.emit(new_text)
+            generation_thread.join()
+
+            if "error" in outcome:
+                raise outcome["error"]
+
+            # Текст уже декодирован стримером - повторный batch_decode всей последовательности не нужен
+            decoded = ["".join(chunks)]
+            generation_time = time.time() - start_time
+            self.log.emit(f"Генерация завершена за {generation_time:.1f} сек")
+        else:
+            outputs = generate()
 
             generation_time = time.time() - start_time
             self.log.emit(f"Генерация завершена за {generation_time:.1f} сек")
 
-            # Декодирование сгенерированных токенов в читаемый текст
-            generated_ids = [
-                out_ids[len(in_ids):]
-                for in_ids, out_ids in zip(inputs.input_ids, outputs)
-            ]
+            # Декодирование сгенерированных токенов в читаемый текст.
+            # При левом паддинге все промты пакета имеют одну длину - ответ отрезается одним срезом
+            generated_ids = outputs[:, inputs["input_ids"].shape[1]:]
 
             decoded = self.processor.batch_decode(
                 generated_ids,
@@ -118,29 +391,243 @@ class OCRWorker(QObject):
                 clean_up_tokenization_spaces=True
             )
 
-            result = decoded[0].strip() if isinstance(decoded, list) and len(decoded) > 0 else ""
+        return [self.clean_result(text) for text in decoded]
 
-            # Очистка результата от обрамляющих Markdown-тегов
-            if result.startswith("```markdown"):
-                result = result[len("```markdown"):].lstrip()
-            if result.endswith("```"):
-                result = result[:-len("```")].rstrip()
+    @staticmethod
+    def clean_result(text):
+        """Очищает результат от обрамляющих Markdown-тегов и проверяет, что он не пустой."""
+        result = text.strip()
 
-            # Проверка на пустой результат
-            if len(result) < 5:
-                result = "Модель не смогла извлечь текст из изображения. Попробуйте другое изображение или проверьте качество."
+        # Очистка результата от обрамляющих Markdown-тегов
+        if result.startswith("```markdown"):
+            result = result[len("```markdown"):].lstrip()
+        if result.endswith("```"):
+            result = result[:-len("```")].rstrip()
 
-            self.finished.emit(result)
-            self.log.emit("Готово!")
+        # Проверка на пустой результат
+        if len(result) < 5:
+            result = "Модель не смогла извлечь текст из изображения. Попробуйте другое изображение или проверьте качество."
+
+        return result
+
+class ModelLoader(QObject):
+    """Загружает, компилирует и прогревает модель в отдельном потоке, чтобы интерфейс не зависал."""
+    finished = Signal(object, object, object)  # Сигнал с процессором, моделью и KV-кэшем (None при ошибке)
+    log = Signal(str)                          # Сигнал для записи в лог
+
+    def __init__(self, model_path, max_new_tokens=DEFAULT_MAX_NEW_TOKENS):
+        super().__init__()
+        self.model_path = model_path
+        self.max_new_tokens = max_new_tokens
+
+    @Slot()
+    def run(self):
+        """Загружает модель, компилирует ее, создает KV-кэш и выполняет прогрев."""
+        try:
+            processor, model = self.load_model(self.model_path)
+
+            originals = self.compile_model(model)
+
+            # Предвыделенный KV-кэш: память под всю генерацию выделяется один раз за сеанс
+            kv_cache = build_kv_cache(model, self.max_new_tokens)
+
+            # torch.compile компилирует только при первом вызове, поэтому ошибки компиляции
+            # (например, нет Triton) проявляются при прогреве. Тогда модель возвращается в eager-режим
+            if not self.warmup_model(processor, model, kv_cache) and originals:
+                for module, forward in originals:
+                    module.forward = forward
+                self.log.emit("⚠️ Скомпилированная модель не запустилась, используется eager-режим.")
+                self.warmup_model(processor, model, kv_cache)
+
+            self.finished.emit(processor, model, kv_cache)
 
-        except torch.cuda.OutOfMemoryError:
-            error_msg = "ОШИБКА: Недостаточно видеопамяти!"
-            self.log.emit(error_msg)
-            self.finished.emit(error_msg)
         except Exception as e:
-            error_msg = f"Ошибка: {e}\n{traceback.format_exc()}"
+            error_msg = f"❌ Ошибка загрузки: {e}\n{traceback.format_exc()}"
             self.log.emit(error_msg)
-            self.finished.emit("")
+            self.finished.emit(None, None, None)
+
+    def load_model(self, model_path):
+        """Загружает модель и процессор с оптимизациями для 4-битного квантования."""
+        import torch
+        from transformers import (
+            AutoConfig, AutoProcessor, BitsAndBytesConfig,
+            Qwen2_5_VLForConditionalGeneration
+        )
+        from transformers.utils import is_flash_attn_2_available
+
+        # Быстрый процессор изображений принимает CUDA-тензоры (см. OCRWorker.gpu_preprocessing)
+        processor = AutoProcessor.from_pretrained(
+            model_path,
+            trust_remote_code=True,
+            use_fast=True
+        )
+        # Для пакетной генерации промты выравниваются паддингом слева
+        processor.tokenizer.padding_side = "left"
+
+        # bf16 имеет тот же диапазон, что и fp32 (нет переполнения в softmax); fp16 - для GPU без поддержки bf16
+        if torch.cuda.is_available() and torch.cuda.is_bf16_supported():
+            compute_dtype = torch.bfloat16
+        else:
+            compute_dtype = torch.float16
+
+        # Уже квантованные чекпоинты (bnb4) несут свой quantization_config.
+        # Остальные квантуются в NF4 на лету: только языковая модель, визуальный энкодер
+        # и выходная проекция lm_head остаются в bf16/fp16 (список заменяет стандартный, поэтому lm_head указан явно)
+        quantization_config = None
+        config = AutoConfig.from_pretrained(model_path, trust_remote_code=True)
+        if getattr(config, "quantization_config", None) is None and torch.cuda.is_available():
+            quantization_config = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=compute_dtype,
+                bnb_4bit_use_double_quant=True,
+                llm_int8_skip_modules=["visual", "lm_head"],
+            )
+            self.log.emit("Модель не квантована, применяется NF4-квантование языковой модели.")
+
+        # Исправлено: 'torch_dtype' -> 'dtype'
+        load_kwargs = dict(
+            device_map="auto",
+            dtype=compute_dtype,
+            quantization_config=quantization_config,
+            trust_remote_code=True,
+            low_cpu_mem_usage=True,
+        )
+
+        # FlashAttention 2 (если установлен flash-attn и GPU не старше Ampere), иначе SDPA. Выбор применяется
+        # и к языковой модели, и к визуальному энкодеру. Ядра FA2 на GPU с compute capability ниже 8.0
+        # падают только при вызове, поэтому поколение GPU проверяется заранее
+        use_flash_attention = (
+            is_flash_attn_2_available()
+            and torch.cuda.is_available()
+            and torch.cuda.get_device_capability()[0] >= 8
+        )
+        attn_implementation = "flash_attention_2" if use_flash_attention else "sdpa"
+        try:
+            model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
+                model_path, attn_implementation=attn_implementation, **load_kwargs
+            )
+        except (ImportError, ValueError) as e:
+            if attn_implementation == "sdpa":
+                raise
+            self.log.emit(f"⚠️ FlashAttention 2 недоступен, используется SDPA: {e}")
+            attn_implementation = "sdpa"
+            model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
+                model_path, attn_implementation=attn_implementation, **load_kwargs
+            )
+
+        self.log.emit("✅ Модель загружена успешно.")
+        self.log.emit(f"Устройство: {model.device}, тип данных: {compute_dtype}, внимание: {attn_implementation}")
+        if hasattr(model, 'quantization_method'):
+            self.log.emit(f"Метод квантования: {model.quantization_method}")
+
+        return processor, model
+
+    def compile_model(self, model):
+        """Оборачивает forward модели и визуального энкодера в torch.compile.
+
+        Возвращает список пар (модуль, исходный forward) для возврата в eager-режим.
+        """
+        import torch
+
+        originals = []
+        if not torch.cuda.is_available():
+            return originals
+        try:
+            from torch.utils._triton import has_triton
+            if not has_triton():
+                self.log.emit("⚠️ Triton не установлен, torch.compile не используется (eager-режим).")
+                return originals
+        except ImportError:
+            pass
+
+        try:
+            # Скомпилированные графы сохраняются на диск и переиспользуются при следующих запусках
+            os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", TORCH_COMPILE_CACHE_DIR)
+            import torch._inductor.config
+            torch._inductor.config.fx_graph_cache = True
+
+            # dynamic=True: количество токенов изображения меняется от запроса к запросу.
+            # Режим по умолчанию, без CUDA-графов: генерация идет в других потоках, чем прогрев
+            originals.append((model, model.forward))
+            model.forward = torch.compile(
+                model.forward,
+                fullgraph=False,
+                dynamic=True,
+            )
+            self.log.emit("✅ Модель обернута в torch.compile.")
+        except Exception as e:
+            self.log.emit(f"⚠️ torch.compile недоступен, используется eager-режим: {e}")
+            for module, forward in originals:
+                module.forward = forward
+            return []
+
+        try:
+            # Размер входа визуального энкодера меняется от изображения к изображению, поэтому
+            # он компилируется с динамическими формами: без перекомпиляции и автотюнинга на каждый размер
+            visual = model.visual
+            originals.append((visual, visual.forward))
+            visual.forward = torch.compile(
+                visual.forward,
+                dynamic=True,
+            )
+            self.log.emit("✅ Визуальный энкодер обернут в torch.compile.")
+        except Exception as e:
+            self.log.emit(f"⚠️ Не удалось скомпилировать визуальный энкодер: {e}")
+        return originals
+
+    def warmup_model(self, processor, model, kv_cache):
+        """Выполняет пробную генерацию, чтобы компиляция прошла до первого запроса пользователя.
+
+        Возвращает True, если генерация прошла успешно.
+        """
+        import torch
+        from qwen_vl_utils import process_vision_info
+
+        try:
+            self.log.emit("🔄 Прогрев модели...")
+            start_time = time.time()
+            # Минимальный размер, который принимает процессор Qwen2.5-VL (кратно 28)
+            dummy_img = Image.new("RGB", (56, 56), color="white")
+            messages = [
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "image", "image": dummy_img},
+                        {"type": "text", "text": "OCR"}
+                    ],
+                }
+            ]
+            text_prompt = processor.apply_chat_template(
+                messages,
+                tokenize=False,
+                add_generation_prompt=True
+            )
+            image_inputs, video_inputs = process_vision_info(messages)
+            inputs = processor(
+                text=[text_prompt],
+                images=image_inputs,
+                videos=video_inputs,
+                padding=True,
+                return_tensors="pt"
+            ).to(model.device)
+
+            with torch.inference_mode():
+                if kv_cache is not None:
+                    kv_cache.reset()
+                model.generate(
+                    **inputs,
+                    max_new_tokens=4,
+                    do_sample=False,
+                    pad_token_id=processor.tokenizer.eos_token_id,
+                    use_cache=True,
+                    past_key_values=kv_cache,
+                )
+            self.log.emit(f"✅ Прогрев завершен за {time.time() - start_time:.1f} сек")
+            return True
+        except Exception as e:
+            self.log.emit(f"⚠️ Не удалось прогреть модель: {e}")
+            return False
 
 class MainWindow(QWidget):
     """Главное окно приложения. Управляет UI и логикой взаимодействия с пользователем."""
@@ -152,11 +639,25 @@ class MainWindow(QWidget):
 
         # Инициализация переменных состояния
         self.current_model_path = None
-        self.image_path = None
+        self.loaded_model_path = None
+        self.image_paths = []
         self.processor = None
         self.model = None
+        self.kv_cache = None
+        self._prompt_cache = {}
+        self._folder_run = False
         self.thread = None
         self.worker = None
+        self.loader_thread = None
+        self.loader = None
+        self._loading_model_path = None
+
+        # Сообщения лога копятся в буфере и выводятся в UI пачкой не чаще раза в 100 мс
+        self._log_buf = []
+        self._log_timer = QTimer(self)
+        self._log_timer.setInterval(100)
+        self._log_timer.timeout.connect(self.flush_log)
+        self._log_timer.start()
 
         # Словарь шаблонов промтов будет загружен позже, после создания UI
         self.prompt_templates = {}
@@ -218,13 +719,28 @@ class MainWindow(QWidget):
         self.info_log_path = os.path.join(self.session_log_dir, "info.log")
         self.text_log_path = os.path.join(self.session_log_dir, "text.log")
 
-        # Инициализируем файлы (создаем пустые, если не существуют)
-        open(self.info_log_path, 'a').close()
-        open(self.text_log_path, 'a').close()
+        # Файлы открываются один раз на весь сеанс: каждый логгер держит свой FileHandler
+        self.info_logger = self._create_file_logger("numarkdown.info", self.info_log_path)
+        self.text_logger = self._create_file_logger("numarkdown.text", self.text_log_path)
 
         # Логирование инициализации будет выполнено позже, после создания UI
         # self.log("✅ Система логирования инициализирована.")
 
+    @staticmethod
+    def _create_file_logger(name, path):
+        """Создает логгер, пишущий сообщения с отметкой времени [ЧЧ:ММ:СС] в указанный файл."""
+        logger = logging.getLogger(name)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            handler.close()
+
+        handler = logging.FileHandler(path, encoding='utf-8')
+        handler.setFormatter(logging.Formatter("[%(asctime)s] %(message)s", datefmt="%H:%M:%S"))
+        logger.addHandler(handler)
+        return logger
+
     def _build_ui(self):
         """Создает и настраивает все элементы пользовательского интерфейса."""
         layout = QVBoxLayout(self)
@@ -253,9 +769,12 @@ class MainWindow(QWidget):
         self.btn_choose = QPushButton("📂 Выбрать изображение")
         top_panel.addWidget(self.btn_choose, 0, 2)
 
+        self.btn_choose_folder = QPushButton("🗂 Выбрать папку")
+        top_panel.addWidget(self.btn_choose_folder, 0, 3)
+
         self.btn_run = QPushButton("🚀 Запустить OCR")
         self.btn_run.setStyleSheet("background-color: #4CAF50; color: white;")
-        top_panel.addWidget(self.btn_run, 0, 3)
+        top_panel.addWidget(self.btn_run, 0, 4)
 
         # Строка 2: Поле ввода промта и выбор шаблона
         prompt_label = QLabel("Промт:")
@@ -264,11 +783,31 @@ class MainWindow(QWidget):
         self.text_prompt = QPlainTextEdit()
         self.text_prompt.setPlaceholderText("Введите промт здесь...")
         self.text_prompt.setMaximumHeight(60)
-        top_panel.addWidget(self.text_prompt, 1, 1, 1, 2)
+        top_panel.addWidget(self.text_prompt, 1, 1, 1, 3)
 
         self.combo_templates = QComboBox()
         self.combo_templates.setMaximumWidth(150)  # Ограничение ширины для компактности UI
-        top_panel.addWidget(self.combo_templates, 1, 3)
+        top_panel.addWidget(self.combo_templates, 1, 4)
+
+        # Строка 3: Ограничение длины ответа
+        max_tokens_label = QLabel("Макс. токенов:")
+        top_panel.addWidget(max_tokens_label, 2, 0)
+
+        self.spin_max_tokens = QSpinBox()
+        self.spin_max_tokens.setRange(64, MAX_NEW_TOKENS_LIMIT)
+        self.spin_max_tokens.setSingleStep(256)
+        self.spin_max_tokens.setValue(DEFAULT_MAX_NEW_TOKENS)
+        self.spin_max_tokens.setToolTip("Увеличьте для длинных страниц. Чем меньше значение, тем меньше KV-кэш и быстрее генерация.")
+        top_panel.addWidget(self.spin_max_tokens, 2, 1, Qt.AlignLeft)
+
+        batch_size_label = QLabel("Размер пакета:")
+        top_panel.addWidget(batch_size_label, 2, 2, Qt.AlignRight)
+
+        self.spin_batch_size = QSpinBox()
+        self.spin_batch_size.setRange(1, MAX_BATCH_SIZE)
+        self.spin_batch_size.setValue(DEFAULT_BATCH_SIZE)
+        self.spin_batch_size.setToolTip("Сколько изображений из папки распознается за один проход. Уменьшите при нехватке видеопамяти.")
+        top_panel.addWidget(self.spin_batch_size, 2, 3, Qt.AlignLeft)
 
         layout.addLayout(top_panel)
 
@@ -325,6 +864,7 @@ class MainWindow(QWidget):
 
         # Подключение сигналов к слотам
         self.btn_choose.clicked.connect(self.choose_image)
+        self.btn_choose_folder.clicked.connect(self.choose_folder)
         self.btn_run.clicked.connect(self.start_ocr)
         self.btn_copy.clicked.connect(self.copy_result_to_clipboard)
         # <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
@@ -337,7 +877,9 @@ class MainWindow(QWidget):
                 self.log(f"Папка моделей не найдена: {BASE_MODEL_DIR}")
                 return
 
-            model_dirs = [d for d in os.listdir(BASE_MODEL_DIR) if os.path.isdir(os.path.join(BASE_MODEL_DIR, d))]
+            # os.scandir отдает тип записи вместе со списком, без отдельного stat() на каждую папку
+            with os.scandir(BASE_MODEL_DIR) as entries:
+                model_dirs = [e.name for e in entries if e.is_dir()]
             if not model_dirs:
                 self.log("В папке model_bnb4 не найдено моделей.")
                 return
@@ -372,51 +914,85 @@ class MainWindow(QWidget):
             self, "Выберите изображение", "", "Images (*.png *.jpg *.jpeg *.bmp *.tiff)"
         )
         if path:
-            self.image_path = path
+            self.image_paths = [path]
             self.log(f"✅ Выбран файл: {os.path.basename(path)}")
 
+    def choose_folder(self):
+        """Открывает диалоговое окно для выбора папки. Все изображения из нее обрабатываются пакетами."""
+        folder = QFileDialog.getExistingDirectory(self, "Выберите папку с изображениями")
+        if not folder:
+            return
+
+        image_paths = sorted(
+            os.path.join(folder, name) for name in os.listdir(folder)
+            if name.lower().endswith(IMAGE_EXTENSIONS)
+        )
+        if not image_paths:
+            self.log(f"⚠️ В папке {os.path.basename(folder)} не найдено изображений.")
+            return
+
+        self.image_paths = image_paths
+        self.log(f"✅ Выбрана папка: {os.path.basename(folder)}, изображений: {len(image_paths)}")
+
     def start_ocr(self):
         """Запускает процесс OCR. Создает и запускает рабочий поток."""
-        if not self.image_path:
-            QMessageBox.warning(self, "Внимание", "Пожалуйста, выберите изображение.")
+        if not self.image_paths:
+            QMessageBox.warning(self, "Внимание", "Пожалуйста, выберите изображение или папку.")
             return
         if not self.current_model_path:
             QMessageBox.critical(self, "Ошибка", "Модель не выбрана.")
             return
 
-        # Загрузка модели, если она еще не загружена
-        if self.processor is None or self.model is None:
-            self.log("🔄 Загрузка модели...")
-            self.processor, self.model = self.load_model(self.current_model_path)
-            if self.processor is None or self.model is None:
-                QMessageBox.critical(self, "Ошибка", "Не удалось загрузить модель.")
-                return
-
-        self.text_output.clear()
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
+        prompt_text = self.text_prompt.toPlainText().strip()
+        if not prompt_text:
+            QMessageBox.warning(self, "Внимание", "Пожалуйста, введите промт.")
+            return
+        if self.loader_thread is not None:
+            return  # Модель еще загружается, OCR запустится после загрузки
 
-        # Остановка предыдущего потока, если он еще работает
+        # Остановка предыдущего потока, если он еще работает (до возможной смены модели,
+        # чтобы загрузка не пересекалась с идущей генерацией)
         if self.thread and self.thread.isRunning():
             self.thread.quit()
             self.thread.wait()
+            # После остановки поток удаляется через deleteLater - ссылка на него больше недействительна
+            self.thread = None
 
-        prompt_text = self.text_prompt.toPlainText().strip()
-        if not prompt_text:
-            QMessageBox.warning(self, "Внимание", "Пожалуйста, введите промт.")
+        # Загрузка модели, если она еще не загружена или выбрана другая.
+        # Загруженная модель остается в памяти между запусками
+        if self.processor is None or self.model is None or self.loaded_model_path != self.current_model_path:
+            self.log("🔄 Загрузка модели...")
+            self.release_model()
+            self.start_model_loading(self.current_model_path)
             return
 
+        self.text_output.clear()
+
+        # Размер KV-кэша линейно зависит от длины последовательности: при смене лимита
+        # токенов кэш пересоздается под новый размер
+        max_new_tokens = self.spin_max_tokens.value()
+        if self.kv_cache is not None and self.kv_cache.max_cache_len != MAX_PROMPT_TOKENS + max_new_tokens:
+            self.kv_cache = None
+            self.kv_cache = build_kv_cache(self.model, max_new_tokens)
+            self.log(f"KV-кэш пересоздан под {max_new_tokens} токенов ответа.")
+
         # Создание и настройка рабочего потока
         self.thread = QThread()
-        self.worker = OCRWorker(self.image_path, prompt_text)
+        self.worker = OCRWorker(
+            self.image_paths, prompt_text, self.kv_cache, max_new_tokens, self.spin_batch_size.value()
+        )
+        self._folder_run = len(self.image_paths) > 1
         self.worker.moveToThread(self.thread)
 
         # Передача модели и процессора в рабочий поток
         self.worker.processor = self.processor
         self.worker.model = self.model
+        self.worker.prompt_cache = self._prompt_cache
 
         # Подключение сигналов
         self.worker.finished.connect(self.display_result)
+        self.worker.partial.connect(self.append_partial_result)
+        self.worker.batch_finished.connect(self.append_batch_result)
         self.worker.log.connect(self.log)
         self.thread.started.connect(self.worker.run)
         self.thread.finished.connect(self.thread.deleteLater)
@@ -424,6 +1000,53 @@ class MainWindow(QWidget):
 
         self.thread.start()
 
+    def release_model(self):
+        """Освобождает предыдущую модель до загрузки новой, чтобы обе не занимали видеопамять одновременно."""
+        had_model = self.model is not None
+        # Рабочий поток тоже держит ссылки на модель, процессор и KV-кэш
+        self.thread = None
+        self.worker = None
+        self.processor, self.model, self.kv_cache = None, None, None
+        if not had_model:
+            return
+
+        import torch
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def start_model_loading(self, model_path):
+        """Запускает загрузку и прогрев модели в отдельном потоке. По окончании OCR запускается автоматически."""
+        self.btn_run.setEnabled(False)
+        self._loading_model_path = model_path
+
+        self.loader_thread = QThread()
+        self.loader = ModelLoader(model_path, self.spin_max_tokens.value())
+        self.loader.moveToThread(self.loader_thread)
+
+        self.loader.log.connect(self.log)
+        self.loader.finished.connect(self.on_model_loaded)
+        self.loader_thread.started.connect(self.loader.run)
+
+        self.loader_thread.start()
+
+    def on_model_loaded(self, processor, model, kv_cache):
+        """Принимает загруженную модель из потока загрузки и продолжает запуск OCR."""
+        self.loader_thread.quit()
+        self.loader_thread.wait()
+        self.loader_thread = None
+        self.loader = None
+        self.btn_run.setEnabled(True)
+
+        if processor is None or model is None:
+            QMessageBox.critical(self, "Ошибка", "Не удалось загрузить модель.")
+            return
+
+        self.processor, self.model, self.kv_cache = processor, model, kv_cache
+        self.loaded_model_path = self._loading_model_path
+        self._prompt_cache.clear()
+        self.start_ocr()
+
     def copy_result_to_clipboard(self):
         """Копирует содержимое поля результата в системный буфер обмена."""
         text = self.text_output.toPlainText()
@@ -434,54 +1057,40 @@ class MainWindow(QWidget):
         else:
             self.log("⚠️ Нет текста для копирования.")
 
+    def append_partial_result(self, text):
+        """Дописывает очередной фрагмент потоковой генерации в конец поля результата."""
+        self.text_output.moveCursor(QTextCursor.End)
+        self.text_output.insertPlainText(text)
+
+    def append_batch_result(self, text):
+        """Дописывает результаты очередного пакета в поле результата и сразу сохраняет их в text.log."""
+        separator = "" if self.text_output.document().isEmpty() else "\n\n---\n\n"
+        self.text_output.moveCursor(QTextCursor.End)
+        self.text_output.insertPlainText(separator + text)
+        self.text_logger.info(f"Распознан текст:\n{text}\n{'-'*50}")
+
     def display_result(self, result):
         """Отображает результат распознавания в соответствующем поле интерфейса и записывает его в text.log."""
         self.text_output.setPlainText(result)
-        # Записываем результат в лог распознанного текста
-        with open(self.text_log_path, 'a', encoding='utf-8') as f:
-            f.write(f"[{datetime.now().strftime('%H:%M:%S')}] Распознан текст:\n{result}\n{'-'*50}\n")
+        # Записываем результат в лог распознанного текста (при обработке папки он записан по пакетам)
+        if not self._folder_run:
+            self.text_logger.info(f"Распознан текст:\n{result}\n{'-'*50}")
 
     def log(self, message):
         """Записывает сообщение в поле лога и в файл info.log."""
         # Вывод в UI
         timestamped_msg = f"[{datetime.now().strftime('%H:%M:%S')}] {message}"
-        self.text_log.appendPlainText(timestamped_msg)
+        self._log_buf.append(timestamped_msg)
 
         # Запись в файл info.log
-        with open(self.info_log_path, 'a', encoding='utf-8') as f:
-            f.write(timestamped_msg + '\n')
-
-    def load_model(self, model_path):
-        """Загружает модель и процессор с оптимизациями для 4-битного квантования."""
-        try:
-            processor = AutoProcessor.from_pretrained(
-                model_path,
-                trust_remote_code=True
-            )
+        self.info_logger.info(message)
 
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
-
-            # Исправлено: 'torch_dtype' -> 'dtype'
-            model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
-                model_path,
-                device_map="auto",
-                dtype=torch.float16,  # Исправлено: torch_dtype -> dtype
-                trust_remote_code=True,
-                low_cpu_mem_usage=True,
-            )
-
-            self.log("✅ Модель загружена успешно.")
-            self.log(f"Устройство: {model.device}")
-            if hasattr(model, 'quantization_method'):
-                self.log(f"Метод квантования: {model.quantization_method}")
-
-            return processor, model
-
-        except Exception as e:
-            error_msg = f"❌ Ошибка загрузки: {e}\n{traceback.format_exc()}"
-            self.log(error_msg)
-            return None, None
+    def flush_log(self):
+        """Выводит накопленные сообщения лога в UI одним вызовом appendPlainText."""
+        if not self._log_buf:
+            return
+        self.text_log.appendPlainText("\n".join(self._log_buf))
+        self._log_buf.clear()
 
 def main():
     """Точка входа в приложение. Создает и запускает главное окно."""